@@ -77,10 +77,7 @@ class NDSimulator(AbstractDiffractionPatternCalculator):
         Returns:
             (NDPattern)
         """
-        try:
-            assert(self.symprec == 0)
-        except:
-            print('symprec is not zero, terminate the process and check your input..')
+        assert(self.symprec == 0), 'symprec is not zero, check your input..'
         if self.symprec:
             finder = SpacegroupAnalyzer(structure, symprec=self.symprec)
             structure = finder.get_refined_structure()
@@ -93,10 +90,7 @@ class NDSimulator(AbstractDiffractionPatternCalculator):
 
         # Obtained from Bragg condition. Note that reciprocal lattice
         # vector length is 1 / d_hkl.
-        try:
-            assert(two_theta_range == None)
-        except:
-            print('two theta range is not None, terminate the process and check your input..')
+        assert(two_theta_range is None), 'two theta range is not None, check your input..'
         min_r, max_r = (
             (0, 2 / wavelength)
             if two_theta_range is None
@@ -119,12 +113,10 @@ class NDSimulator(AbstractDiffractionPatternCalculator):
         occus = []
         dwfactors = []
 
+        # do not consider mixed species at the same site
+        assert(all(len(site.species) == 1 for site in structure)), \
+            'mixed species at the same site detected..'
         for site in structure:
-            # do not consider mixed species at the same site
-            try:
-                assert(len(site.species.items()) == 1)
-            except:
-                print('mixed species at the same site detected, abort..')
             for sp, occu in site.species.items():
                 try:
                     c = ATOMIC_SCATTERING_LEN[sp.symbol]
@@ -143,10 +135,8 @@ class NDSimulator(AbstractDiffractionPatternCalculator):
         coeffs = np.array(coeffs)
         fcoords = np.array(fcoords)
         occus = np.array(occus)
-        try:
-            assert(np.max(occus) == np.min(occus) == 1) # all sites should be singly occupied
-        except:
-            print('check occupancy values...')
+        # all sites should be singly occupied
+        assert(np.all(occus == 1)), 'check occupancy values..'
         dwfactors = np.array(dwfactors)
         peaks = {}
         two_thetas = []
@@ -17,7 +17,16 @@ Modified for deepKNet point cloud model
 import os
 import json
 import math
+from functools import lru_cache
 import numpy as np
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.analysis.diffraction.core import AbstractDiffractionPatternCalculator,\
                                                DiffractionPattern, get_unique_families
@@ -55,6 +64,151 @@ with open(os.path.join(os.path.dirname(__file__),
                        "atomic_scattering_params.json")) as f:
     ATOMIC_SCATTERING_PARAMS = json.load(f)
 
+# number of hkl per block in the NumPy structure factor computation
+HKL_BLOCK_SIZE = 1024
+# number of hkl per block in the GPU structure factor computation
+GPU_HKL_BLOCK_SIZE = 65536
+
+
+@lru_cache(maxsize=None)
+def _scattering_coeffs(symbol):
+    """
+    Fitted atomic scattering parameters (a_i, b_i) of an element as two
+    contiguous float32 arrays. Single precision is ample for the
+    scattering factors. Cached by element symbol.
+    """
+    try:
+        c = np.array(ATOMIC_SCATTERING_PARAMS[symbol])
+    except KeyError:
+        raise ValueError("Unable to calculate XRD pattern as "
+                         "there is no scattering coefficients for"
+                         " %s." % symbol)
+    return np.ascontiguousarray(c[:, 0], dtype=np.float32), \
+           np.ascontiguousarray(c[:, 1], dtype=np.float32)
+
+
+def _enumerate_hkl(latt_matrix, recip_matrix, min_r, max_r):
+    """
+    Miller indices and lengths of all crystallographic reciprocal lattice
+    points with min_r <= g_hkl <= max_r, ordered by (g, -h, -k, -l). Since
+    a_i . b_j = delta_ij, any g_hkl within the limiting sphere satisfies
+    |h_i| <= max_r * |a_i|, which bounds the integer miller indices to
+    enumerate. g_hkl = hkl . B with B the reciprocal matrix.
+    """
+    h_max, k_max, l_max = np.ceil(max_r * np.linalg.norm(latt_matrix, axis=1)).astype(int)
+    # descending grid so that a stable sort on g alone breaks ties by (-h, -k, -l)
+    h, k, l = np.ogrid[h_max:-h_max-1:-1, k_max:-k_max-1:-1, l_max:-l_max-1:-1]
+    hkls = np.stack(np.broadcast_arrays(h, k, l), axis=-1).reshape(-1, 3)
+    g_hkls = np.linalg.norm(np.dot(hkls, recip_matrix), axis=1)
+
+    # skip origin and points on the limiting sphere to avoid precision problems
+    in_range = (g_hkls >= max(min_r, 1e-4)) & (g_hkls <= max_r)
+    hkls, g_hkls = hkls[in_range], g_hkls[in_range]
+    order = np.argsort(g_hkls, kind='stable')
+    return hkls[order], g_hkls[order]
+
+
+def _structure_factors_numpy(hkls, fcoords, fs_u, inverse, occus):
+    """
+    Real and imaginary parts of the structure factors of all hkl with
+    NumPy. Atoms are grouped by species, F_hkl = sum_sp f_sp * T_sp with
+    the geometric factor T_sp = sum_{j in sp} occu_j * exp(2j * pi * g.r_j),
+    whose phase is evaluated as a (cos, sin) pair on real arrays.
+    """
+    n_hkl = hkls.shape[0]
+    f_re = np.zeros(n_hkl)
+    f_im = np.zeros(n_hkl)
+    # float hkl and 2 pi * fcoords so that the phases come straight out of
+    # a float64 matrix product (dgemm), without an N_hkl x N_atom rescale
+    hkls = hkls.astype(float)
+    species = [(2 * math.pi * fcoords[inverse == u].T, occus[inverse == u])
+               for u in range(fs_u.shape[1])]
+    # hkl are processed in blocks to cap the size of the phase arrays
+    for start in range(0, n_hkl, HKL_BLOCK_SIZE):
+        block = slice(start, start + HKL_BLOCK_SIZE)
+        for u, (fcoords_sp, occus_sp) in enumerate(species):
+            phases = np.dot(hkls[block], fcoords_sp)
+            f_re[block] += fs_u[block, u] * np.dot(np.cos(phases), occus_sp)
+            f_im[block] += fs_u[block, u] * np.dot(np.sin(phases), occus_sp)
+    return f_re, f_im
+
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _structure_factor_numba(h, k, l, xyz, fs_m, inverse, occus):
+        """
+        Real and imaginary parts of the structure factor of one hkl.
+        Accumulates f_j * occu_j * exp(2j * pi * g.r_j) atom by atom without
+        building the N_hkl x N_atom phase array.
+        """
+        acc_re = 0.
+        acc_im = 0.
+        for j in range(xyz.shape[1]):
+            phase = h * xyz[0, j] + k * xyz[1, j] + l * xyz[2, j]
+            weight = fs_m[inverse[j]] * occus[j]
+            acc_re += weight * np.cos(phase)
+            acc_im += weight * np.sin(phase)
+        return acc_re, acc_im
+
+    @njit(fastmath=True, cache=True)
+    def _structure_factors_numba(hkls, fcoords, fs_u, inverse, occus):
+        """
+        Real and imaginary parts of the structure factors of all hkl on a
+        single thread, the default since simulators usually run one per
+        process in a multiprocessing pool.
+        """
+        n_hkl = hkls.shape[0]
+        # 2 pi * fractional coordinates, one contiguous row per axis so the
+        # inner loop over atoms is unit stride
+        xyz = np.ascontiguousarray(2 * np.pi * fcoords.T)
+        f_re = np.empty(n_hkl)
+        f_im = np.empty(n_hkl)
+        for m in range(n_hkl):
+            f_re[m], f_im[m] = _structure_factor_numba(hkls[m, 0], hkls[m, 1], hkls[m, 2],
+                                                       xyz, fs_u[m], inverse, occus)
+        return f_re, f_im
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _structure_factors_numba_parallel(hkls, fcoords, fs_u, inverse, occus):
+        """
+        Same as _structure_factors_numba, multithreaded over hkl.
+        """
+        n_hkl = hkls.shape[0]
+        xyz = np.ascontiguousarray(2 * np.pi * fcoords.T)
+        f_re = np.empty(n_hkl)
+        f_im = np.empty(n_hkl)
+        for m in prange(n_hkl):
+            f_re[m], f_im[m] = _structure_factor_numba(hkls[m, 0], hkls[m, 1], hkls[m, 2],
+                                                       xyz, fs_u[m], inverse, occus)
+        return f_re, f_im
+else:
+    _structure_factors_numba = None
+    _structure_factors_numba_parallel = None
+
+
+def _structure_factors_cupy(hkls, fcoords, fs_u, inverse, occus):
+    """
+    Real and imaginary parts of the structure factors of all hkl on the
+    GPU with CuPy. Same blocked computation as the NumPy path, with the
+    per-atom weights f_j * occu_j gathered on the device.
+    """
+    n_hkl = hkls.shape[0]
+    hkls = cp.asarray(hkls, dtype=cp.float64)
+    fcoords_t = cp.asarray(2 * math.pi * fcoords.T)
+    fs_u = cp.asarray(fs_u)
+    inverse = cp.asarray(inverse)
+    occus = cp.asarray(occus)
+    f_re = cp.empty(n_hkl)
+    f_im = cp.empty(n_hkl)
+    for start in range(0, n_hkl, GPU_HKL_BLOCK_SIZE):
+        block = slice(start, start + GPU_HKL_BLOCK_SIZE)
+        phases = cp.dot(hkls[block], fcoords_t)
+        weights = fs_u[block][:, inverse] * occus
+        f_re[block] = cp.sum(weights * cp.cos(phases), axis=1)
+        f_im[block] = cp.sum(weights * cp.sin(phases), axis=1)
+    return cp.asnumpy(f_re), cp.asnumpy(f_im)
+
+
 class XRDSimulator(AbstractDiffractionPatternCalculator):
     """
     Computes the XRD pattern of a crystal structure.
@@ -110,7 +264,7 @@ class XRDSimulator(AbstractDiffractionPatternCalculator):
            {\\sin^2(\\theta)\\cos(\\theta)}
     """
 
-    def __init__(self, wavelength="CuKa", symprec=0):
+    def __init__(self, wavelength="CuKa", symprec=0, use_gpu=False, parallel=False):
         """
         Initializes the XRD calculator with a given radiation.
 
@@ -124,12 +278,21 @@ class XRDSimulator(AbstractDiffractionPatternCalculator):
             symprec (float): Symmetry precision for structure refinement. If
                 set to 0, no refinement is done. Otherwise, refinement is
                 performed using spglib with provided precision.
+            use_gpu (bool): Whether to compute structure factors on the GPU
+                with CuPy. Falls back to the CPU if CuPy or a CUDA device is
+                not available. Defaults to False.
+            parallel (bool): Whether to compute structure factors with a
+                multithreaded numba kernel. Leave off when the simulator
+                already runs in every worker of a process pool, otherwise
+                each worker starts its own thread pool. Defaults to False.
         """
         if isinstance(wavelength, float):
             self.wavelength = wavelength
         else:
             self.wavelength = WAVELENGTHS[wavelength]
         self.symprec = symprec
+        self.use_gpu = use_gpu and cp is not None and cp.cuda.is_available()
+        self.parallel = parallel
 
     def get_pattern(self, structure, scale_intensity=True, two_theta_range=None):
         """
@@ -150,10 +313,7 @@ class XRDSimulator(AbstractDiffractionPatternCalculator):
             list of features for point cloud representation,
             recip_latt
         """
-        try:
-            assert(self.symprec == 0)
-        except:
-            print('symprec is not zero, terminate the process and check your input..')
+        assert(self.symprec == 0), 'symprec is not zero, check your input..'
         if self.symprec:
             finder = SpacegroupAnalyzer(structure, symprec=self.symprec)
             structure = finder.get_refined_structure()
@@ -164,130 +324,119 @@ class XRDSimulator(AbstractDiffractionPatternCalculator):
 
         # Obtained from Bragg condition. Note that reciprocal lattice
         # vector length is 1 / d_hkl.
-        try:
-            assert(two_theta_range == None)
-        except:
-            print('two theta range is not None, terminate the process and check your input..')
+        assert(two_theta_range is None), 'two theta range is not None, check your input..'
         min_r, max_r = (0., 2. / self.wavelength) if two_theta_range is None else \
             [2 * math.sin(math.radians(t / 2)) / self.wavelength for t in two_theta_range]
 
         # Obtain crystallographic reciprocal lattice points within range
-        # recip_pts entry: [coord, distance, index, image]
         recip_latt = latt.reciprocal_lattice_crystallographic
-        recip_pts = recip_latt.get_points_in_sphere(
-            [[0, 0, 0]], [0, 0, 0], max_r)
-        if min_r:
-            recip_pts = [pt for pt in recip_pts if pt[1] >= min_r]
-        
-        # Create a flattened array of zs, coeffs, fcoords and occus. This is
-        # used to perform vectorized computation of atomic scattering factors
-        # later. Note that these are not necessarily the same size as the
-        # structure as each partially occupied specie occupies its own
-        # position in the flattened array.
-        zs = []
-        coeffs = []
-        fcoords = []
-        occus = []
-
-        for site in structure:
-            # do not consider mixed species at the same site
-            try:
-                assert(len(site.species.items()) == 1)
-            except:
-                print('mixed species at the same site detected, abort..')
-            for sp, occu in site.species.items():
-                zs.append(sp.Z)
-                try:
-                    c = ATOMIC_SCATTERING_PARAMS[sp.symbol]
-                except KeyError:
-                    raise ValueError("Unable to calculate XRD pattern as "
-                                     "there is no scattering coefficients for"
-                                     " %s." % sp.symbol)
-                coeffs.append(c)
-                fcoords.append(site.frac_coords)
-                occus.append(occu)
-
-        zs = np.array(zs)
-        coeffs = np.array(coeffs)
-        fcoords = np.array(fcoords)
-        occus = np.array(occus)
-        try:
-            assert(np.max(occus) == np.min(occus) == 1) # all sites should be singly occupied
-        except:
-            print('check occupancy values...')
+        hkls, g_hkls = _enumerate_hkl(latt.matrix, recip_latt.matrix, min_r, max_r)
+
+        # Create flattened arrays of zs, symbols, fcoords and occus, one
+        # entry per site. These are used to perform vectorized computation
+        # of atomic scattering factors later.
+        # do not consider mixed species at the same site
+        assert(all(len(site.species) == 1 for site in structure)), \
+            'mixed species at the same site detected..'
+        species = [next(iter(site.species.items())) for site in structure]
+        zs = np.fromiter((sp.Z for sp, _ in species), dtype=np.int64, count=len(species))
+        symbols = [sp.symbol for sp, _ in species]
+        fcoords = structure.frac_coords
+        occus = np.fromiter((occu for _, occu in species), dtype=float, count=len(species))
+        # all sites should be singly occupied
+        assert(np.all(occus == 1)), 'check occupancy values..'
+        total_electrons = zs.sum()
+        electrons2 = total_electrons * total_electrons
+        volume2 = volume * volume
+        features = [[0, 0, 0, float(electrons2 / volume2)]]
+
+        # Bragg condition, clipped so that points on the limiting sphere
+        # cannot leave the domain of arcsin through rounding
+        sin_thetas = np.minimum(self.wavelength * g_hkls / 2, 1.)
+        thetas = np.arcsin(sin_thetas)
+
+        # s = sin(theta) / wavelength = 1 / 2d = |ghkl| / 2 (d =
+        # 1/|ghkl|)
+        s = g_hkls / 2
+
+        # Store s^2 since we are using it a few times.
+        s2 = s * s
+
+        # Highly vectorized computation of atomic scattering factors over
+        # all hkl at once. Atoms of the same species share the scattering
+        # factor, so it is only evaluated for the unique species, and
+        # symmetry equivalent hkl share s^2, so it is only evaluated for the
+        # unique s^2 values and then gathered. Output size is
+        # N_hkl x N_species. Equivalent non-vectorized code is::
+        #
+        #   for site in structure:
+        #      el = site.specie
+        #      coeff = ATOMIC_SCATTERING_PARAMS[el.symbol]
+        #      fs = el.Z - 41.78214 * s2 * sum(
+        #          [d[0] * exp(-d[1] * s2) for d in coeff])
+        zs_u, species_idx, inverse = np.unique(zs, return_index=True, return_inverse=True)
+        # The fitted a_i, b_i are kept in single precision, phases stay in
+        # double precision to keep systematic absences at zero.
+        a_u, b_u = (np.array(c) for c in zip(*[_scattering_coeffs(symbols[i])
+                                               for i in species_idx]))
+        # s^2 equal up to floating point noise share one table entry
+        _, s2_idx, s2_inverse = np.unique(np.round(s2, 10), return_index=True,
+                                          return_inverse=True)
+        s2_u = s2[s2_idx].astype(np.float32)
+        fs_u = zs_u.astype(np.float32)[None, :] - np.float32(41.78214) * s2_u[:, None] * \
+            np.sum(a_u[None, :, :] * np.exp(-b_u[None, :, :] * s2_u[:, None, None]), axis=2)
+        fs_u = fs_u[s2_inverse]
+
+        # Structure factor = sum of atomic scattering factors (with
+        # position factor exp(2j * pi * g.r and occupancies).
+        # On the GPU if requested, compiled with numba when available
+        # (multithreaded only if requested), vectorized NumPy otherwise.
+        if self.use_gpu:
+            f_re, f_im = _structure_factors_cupy(hkls, fcoords, fs_u, inverse, occus)
+        elif _structure_factors_numba is not None and self.parallel:
+            f_re, f_im = _structure_factors_numba_parallel(hkls, fcoords, fs_u, inverse, occus)
+        elif _structure_factors_numba is not None:
+            f_re, f_im = _structure_factors_numba(hkls, fcoords, fs_u, inverse, occus)
+        else:
+            f_re, f_im = _structure_factors_numpy(hkls, fcoords, fs_u, inverse, occus)
+
+        # Lorentz polarization correction for hkl, written in terms of
+        # sin(theta) from the Bragg condition:
+        # cos(2 theta) = 1 - 2 sin^2(theta), cos(theta) = sqrt(1 - sin^2(theta))
+        sin2_thetas = sin_thetas * sin_thetas
+        cos_2thetas = 1 - 2 * sin2_thetas
+        lorentz_factors = (1 + cos_2thetas * cos_2thetas) / \
+            (sin2_thetas * np.sqrt(1 - sin2_thetas))
+
+        # Intensity for hkl is modulus square of structure factor.
+        i_hkls = f_re * f_re + f_im * f_im
+        assert(np.all(i_hkls < electrons2)), 'check I_hkl values..'
+
+        # add to features
+        features.extend(np.column_stack((hkls, i_hkls / volume2)).tolist())
+
+        ### for diffractin pattern plotting only
+        two_thetas = np.degrees(2 * thetas)
+        if is_hex:
+            # Use Miller-Bravais indices for hexagonal lattices.
+            peak_hkls = np.column_stack((hkls[:, 0], hkls[:, 1],
+                                         - hkls[:, 0] - hkls[:, 1], hkls[:, 2]))
+        else:
+            peak_hkls = hkls
+        # Deal with floating point precision issues. Points are sorted by
+        # g_hkl, so two_thetas is non-decreasing and reflections closer than
+        # TWO_THETA_TOL are contiguous; each run is accumulated as one peak.
+        new_peak = np.ones(len(two_thetas), dtype=bool)
+        new_peak[1:] = np.diff(two_thetas) >= \
+            AbstractDiffractionPatternCalculator.TWO_THETA_TOL
+        peak_ids = np.cumsum(new_peak) - 1
+        peak_intensities = np.bincount(peak_ids, weights=i_hkls * lorentz_factors)
+        peak_starts = np.flatnonzero(new_peak)
         peaks = {}
-        two_thetas = []
-
-        total_electrons = sum(zs)
-        features = [[0, 0, 0, float(total_electrons/volume)**2]]
-        for hkl, g_hkl, _, _ in sorted(recip_pts,
-                                       key=lambda i: (i[1], -i[0][0], -i[0][1], -i[0][2])):
-            
-            # skip origin and points on the limiting sphere to avoid precision problems
-            if (g_hkl < 1e-4) or (g_hkl > 2./self.wavelength): continue
-
-            d_hkl = 1. / g_hkl
-
-            # Bragg condition
-            theta = math.asin(self.wavelength * g_hkl / 2)
-
-            # s = sin(theta) / wavelength = 1 / 2d = |ghkl| / 2 (d =
-            # 1/|ghkl|)
-            s = g_hkl / 2
-
-            # Store s^2 since we are using it a few times.
-            s2 = s ** 2
-
-            # Vectorized computation of g.r for all fractional coords and
-            # hkl. Output size is N_atom
-            g_dot_r = np.dot(fcoords, np.transpose([hkl])).T[0]
-
-            # Highly vectorized computation of atomic scattering factors.
-            # Equivalent non-vectorized code is::
-            #
-            #   for site in structure:
-            #      el = site.specie
-            #      coeff = ATOMIC_SCATTERING_PARAMS[el.symbol]
-            #      fs = el.Z - 41.78214 * s2 * sum(
-            #          [d[0] * exp(-d[1] * s2) for d in coeff])
-            fs = zs - 41.78214 * s2 * np.sum(
-                coeffs[:, :, 0] * np.exp(-coeffs[:, :, 1] * s2), axis=1)
-            
-            # Structure factor = sum of atomic scattering factors (with
-            # position factor exp(2j * pi * g.r and occupancies).
-            # Vectorized computation.
-            f_hkl = np.sum(fs * occus * np.exp(2j * math.pi * g_dot_r))
-
-            # Lorentz polarization correction for hkl
-            lorentz_factor = (1 + math.cos(2 * theta) ** 2) / \
-                (math.sin(theta) ** 2 * math.cos(theta))
-
-            # Intensity for hkl is modulus square of structure factor.
-            i_hkl = (f_hkl * f_hkl.conjugate()).real
-            try:
-                assert(i_hkl < total_electrons**2)
-            except:
-                print('assertion failed, check I_hkl values..')
-            i_hkl_out = i_hkl / volume**2
-            
-            # add to features 
-            features.append([hkl[0], hkl[1], hkl[2], i_hkl_out])
-
-            ### for diffractin pattern plotting only
-            two_theta = math.degrees(2 * theta)
-            if is_hex:
-                # Use Miller-Bravais indices for hexagonal lattices.
-                hkl = (hkl[0], hkl[1], - hkl[0] - hkl[1], hkl[2])
-            # Deal with floating point precision issues.
-            ind = np.where(np.abs(np.subtract(two_thetas, two_theta)) <
-                           AbstractDiffractionPatternCalculator.TWO_THETA_TOL)
-            if len(ind[0]) > 0:
-                peaks[two_thetas[ind[0][0]]][0] += i_hkl * lorentz_factor
-                peaks[two_thetas[ind[0][0]]][1].append(tuple(hkl))
-            else:
-                peaks[two_theta] = [i_hkl * lorentz_factor, [tuple(hkl)],
-                                    d_hkl]
-                two_thetas.append(two_theta)
+        for start, intensity, hkl_group in zip(peak_starts, peak_intensities,
+                                               np.split(peak_hkls, peak_starts[1:])):
+            peaks[two_thetas[start]] = [intensity, [tuple(hkl) for hkl in hkl_group.tolist()],
+                                        1. / g_hkls[start]]
 
         # Scale intensities so that the max intensity is 100.
         max_intensity = max([v[0] for v in peaks.values()])
@@ -1,56 +1,82 @@
 import os
 import sys
 import ast
+import json
 import shutil
+import time
 import random
+import threading
 import numpy as np
 import pandas as pd
-from collections import defaultdict
+from collections import Counter, defaultdict
+from functools import lru_cache
 import multiprocessing
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 from pymatgen.core.structure import Structure
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# MP properties used to filter and build the datasets
+MP_COLUMNS = [
+    "material_id", "icsd_ids", "warnings", "has_band_structure",
+    "spacegroup", "crystal_system", "volume", "nsites", "elements",
+    "energy_per_atom", "formation_energy_per_atom", "e_above_hull",
+    "band_gap", "elasticity",
+]
+
+# point clouds shared across datasets
+CACHE_DIR = "./datasets/point_cloud_cache/"
+
+# radius of the limiting sphere, CuKa by default
+MAX_R = 2 / 1.54184
+# bound on h, k and l of the selected points for each npoint, None selects
+# the three unit vectors a*, b* and c*
+NPOINT_THRESH = {3: None, 27: 1.1, 125: 2.1, 343: 3.1}
+
+# materials per point cloud task
+POINT_CLOUD_CHUNK = 256
+# (npoint, neutron) -> {material: event set once its point cloud is cached}
+CACHED_POINT_CLOUDS = defaultdict(dict)
+CACHE_LOCK = threading.Lock()
+
+# per-material inputs packed into memory-mapped archives
+ARCHIVE_SUFFIX = {
+    "XRD": "_XRD_conventional.npy",
+    "ND": "_ND_conventional.npy",
+    "basis": "_conventional_basis.npy",
+}
+
 def gen_Xsys_data(data_custom):
     print("\ngenerate XRD crystal system classification data..")
     
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-    
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-
     # show statistics
     show_statistics(data = data_custom)
 
-    # output directory
+    # output directories, generated in __main__
+    jobs = []
     npoints = [125, 343]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_Xsys_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             Xsys_data = data_custom[['material_id', 'crystal_system']]
-            generate_train_valid_test(Xsys_data, out_dir, npoint, random_seed, neutron=False)
+            jobs.append((Xsys_data, out_dir, npoint, random_seed, False))
+    return jobs
 
 
 def gen_THC_data(data_custom):
     print("\ngenerate XRD trigonal-hexagonal classification data..")
     
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-    
     # only take trigonal and hexagonal materials
     print('only take trigonal and hexagonal materials')
     data_custom = data_custom[data_custom['crystal_system'].isin(['trigonal', 'hexagonal'])]
@@ -58,17 +84,16 @@ def gen_THC_data(data_custom):
     # show statistics
     show_statistics(data = data_custom)
 
-    # output directory
+    # output directories, generated in __main__
+    jobs = []
     npoints = [3, 27, 125]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_THC_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             THC_data = data_custom[['material_id', 'crystal_system']]
-            generate_train_valid_test(THC_data, out_dir, npoint, random_seed, neutron=False)
+            jobs.append((THC_data, out_dir, npoint, random_seed, False))
+    return jobs
     
 
 def gen_MIC_data(data_custom):
@@ -78,28 +103,19 @@ def gen_MIC_data(data_custom):
     print('>> remove entries without calculated band structures')
     data_custom = data_custom[data_custom['has_band_structure']]
     
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-    
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-
     # show statistics
     show_statistics(data = data_custom)
 
-    # output directory
+    # output directories, generated in __main__
+    jobs = []
     npoints = [125, 343]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_MIC_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             MIC_data = data_custom[['material_id', 'band_gap']]
-            generate_train_valid_test(MIC_data, out_dir, npoint, random_seed, neutron=False)
+            jobs.append((MIC_data, out_dir, npoint, random_seed, False))
+    return jobs
 
 
 def gen_elasticity_data(data_custom):
@@ -108,65 +124,40 @@ def gen_elasticity_data(data_custom):
     # only take materials with elasticity data
     data_custom = data_custom[data_custom['elasticity'].notnull()]
 
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-    
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-    
     # show statistics
     show_statistics(data = data_custom)
 
-    # elasticity
-    GKP = []
-    for idx, irow in data_custom.iterrows():
-        elasticity = ast.literal_eval(irow['elasticity'])
-        shear_mod = elasticity['G_Voigt_Reuss_Hill']
-        bulk_mod = elasticity['K_Voigt_Reuss_Hill']
-        poisson_ratio = elasticity['poisson_ratio']
-        GKP.append([shear_mod, bulk_mod, poisson_ratio])
-    data_custom['elasticity_data'] = GKP
-
-    # output directory
+    # elasticity, parsed once in __main__
+    data_custom = data_custom.assign(elasticity_data=data_custom[['G', 'K', 'P']].values.tolist())
+
+    # output directories, generated in __main__
+    jobs = []
     npoints = [125, 343]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_elasticity_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             elasticity_data = data_custom[['material_id', 'elasticity_data']]
-            generate_train_valid_test(elasticity_data, out_dir, npoint, random_seed, neutron=False)
+            jobs.append((elasticity_data, out_dir, npoint, random_seed, False))
+    return jobs
 
 
 def gen_stability_data(data_custom):
     print("\ngenerate XRD stability classification data..")
 
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-
     # show statistics
     show_statistics(data = data_custom)
 
-    # output directory
+    # output directories, generated in __main__
+    jobs = []
     npoints = [125, 343]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_stability_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             stability_data = data_custom[['material_id', 'e_above_hull']]
-            generate_train_valid_test(stability_data, out_dir, npoint, random_seed, neutron=False)
+            jobs.append((stability_data, out_dir, npoint, random_seed, False))
+    return jobs
 
 
 def gen_neutron_MIC_data(data_custom):
@@ -176,33 +167,19 @@ def gen_neutron_MIC_data(data_custom):
     print('>> remove entries with no calculated band structures')
     data_custom = data_custom[data_custom['has_band_structure']]
     
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-    
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-
-    # make sure only use compounds with simulated neutron scattering
-    MPdata_files = os.listdir('./MPdata_all/')
-    ND_files = [fname.split('_')[0] for fname in MPdata_files if 'ND' in fname]
-    data_custom = data_custom[data_custom['material_id'].isin(ND_files)]
-
     # show statistics
     show_statistics(data = data_custom)
 
-    # output directory
+    # output directories, generated in __main__
+    jobs = []
     npoints = [125, 343]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_neutron_MIC_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             ND_MIC_data = data_custom[['material_id', 'band_gap']]
-            generate_train_valid_test(ND_MIC_data, out_dir, npoint, random_seed, neutron=True)
+            jobs.append((ND_MIC_data, out_dir, npoint, random_seed, True))
+    return jobs
 
 
 def gen_neutron_elasticity_data(data_custom):
@@ -211,163 +188,298 @@ def gen_neutron_elasticity_data(data_custom):
     # only take materials with elasticity data
     data_custom = data_custom[data_custom['elasticity'].notnull()]
 
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-    
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-    
-    # make sure only use compounds with simulated neutron scattering
-    MPdata_files = os.listdir('./MPdata_all/')
-    ND_files = [fname.split('_')[0] for fname in MPdata_files if 'ND' in fname]
-    data_custom = data_custom[data_custom['material_id'].isin(ND_files)]
-
-    # elasticity
-    GKP = []
-    for idx, irow in data_custom.iterrows():
-        elasticity = ast.literal_eval(irow['elasticity'])
-        shear_mod = elasticity['G_Voigt_Reuss_Hill']
-        bulk_mod = elasticity['K_Voigt_Reuss_Hill']
-        poisson_ratio = elasticity['poisson_ratio']
-        GKP.append([shear_mod, bulk_mod, poisson_ratio])
-    data_custom['elasticity_data'] = GKP
+    # elasticity, parsed once in __main__
+    data_custom = data_custom.assign(elasticity_data=data_custom[['G', 'K', 'P']].values.tolist())
 
     # show statistics
     show_statistics(data = data_custom)
 
-    # output directory
+    # output directories, generated in __main__
+    jobs = []
     npoints = [125, 343]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_neutron_elasticity_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             ND_elasticity_data = data_custom[['material_id', 'elasticity_data']]
-            generate_train_valid_test(ND_elasticity_data, out_dir, npoint, random_seed, neutron=True)
+            jobs.append((ND_elasticity_data, out_dir, npoint, random_seed, True))
+    return jobs
 
 
 def gen_neutron_stability_data(data_custom):
     print("\ngenerate neutron stability classification data..")
 
-    # only take crystals in ICSD
-    print('>> remove entries with no ICSD IDs')
-    data_custom = data_custom[data_custom['icsd_ids'] != '[]']
-
-    # only take no-warning entries
-    print('>> remove entries with warnings')
-    data_custom = data_custom[data_custom['warnings'] == '[]']
-
-    # make sure only use compounds with simulated neutron scattering
-    MPdata_files = os.listdir('./MPdata_all/')
-    ND_files = [fname.split('_')[0] for fname in MPdata_files if 'ND' in fname]
-    data_custom = data_custom[data_custom['material_id'].isin(ND_files)]
-
     # show statistics
     show_statistics(data = data_custom)
 
-    # output directory
+    # output directories, generated in __main__
+    jobs = []
     npoints = [125, 343]
     random_seeds = [123, 456]
     for npoint in npoints:
         for random_seed in random_seeds:
             out_dir = "./datasets/data_neutron_stability_C{}_rand{}/".format(str(npoint), str(random_seed))
-            if os.path.exists(out_dir):
-                shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
             ND_stability_data = data_custom[['material_id', 'e_above_hull']]
-            generate_train_valid_test(ND_stability_data, out_dir, npoint, random_seed, neutron=True)
+            jobs.append((ND_stability_data, out_dir, npoint, random_seed, True))
+    return jobs
+
+
+def reset_dir(out_dir, pool):
+    # move the output of a previous run out of the way and delete it on the
+    # pool in the background, renaming is instant even for huge directories
+    if os.path.exists(out_dir):
+        trash_dir = out_dir.rstrip('/') + '.trash.' + str(time.time())
+        os.rename(out_dir, trash_dir)
+        pool.apply_async(shutil.rmtree, (trash_dir,))
+    os.makedirs(out_dir)
+
+
+@lru_cache(maxsize=None)
+def split_permutation(size, random_seed):
+    # the shuffle only depends on the dataset size and the seed, so it is
+    # shared by all npoints of a dataset
+    perm = np.random.default_rng(random_seed).permutation(size)
+    perm.setflags(write=False)
+    return perm
+
+
+def write_id_prop(data, save_dir):
+    # parquet keeps the column dtypes and the list-valued elasticity
+    # targets, fall back to csv when pyarrow is not installed
+    if pyarrow is not None:
+        data.to_parquet(os.path.join(save_dir, "id_prop.parquet"), compression='zstd', index=False)
+    else:
+        data.to_csv(os.path.join(save_dir, "id_prop.csv"), sep=',', header=data.columns,
+                    index=False, mode='w')
 
 
-def generate_train_valid_test(id_prop_all, out_dir, npoint, random_seed, neutron=False):
-    print('\nsize of dataset:', id_prop_all.shape[0], 'npoint:', npoint, 'random seed:', random_seed, flush=True)
+def generate_train_valid_test(id_prop_all, out_dir, npoint, random_seed, pool, neutron=False):
+    print('\n{} size of dataset:'.format(out_dir), id_prop_all.shape[0], 'npoint:', npoint,
+          'random seed:', random_seed, flush=True)
+    reset_dir(out_dir, pool)
     # random shuffle with seed
-    id_prop_all = id_prop_all.sample(frac=1, random_state=random_seed)
+    id_prop_all = id_prop_all.iloc[split_permutation(id_prop_all.shape[0], random_seed)]
     # split ratio
     train_ratio, valid_ratio = 0.6, 0.2
     # train
     train_dir = os.path.join(out_dir, "train/")
-    os.mkdir(train_dir)
-    train_file = os.path.join(train_dir, "id_prop.csv")
+    os.makedirs(train_dir, exist_ok=True)
     train_split = int(np.floor(id_prop_all.shape[0] * train_ratio))
     train_data = id_prop_all.iloc[:train_split]
-    train_data.to_csv(train_file, sep=',', header=id_prop_all.columns, index=False, mode='w')
+    write_id_prop(train_data, train_dir)
     # valid
     valid_dir = os.path.join(out_dir, "valid/")
-    os.mkdir(valid_dir)
-    valid_file = os.path.join(valid_dir, "id_prop.csv")
+    os.makedirs(valid_dir, exist_ok=True)
     valid_split = train_split + int(np.floor(id_prop_all.shape[0] * valid_ratio))
     valid_data = id_prop_all.iloc[train_split:valid_split]
-    valid_data.to_csv(valid_file, sep=',', header=id_prop_all.columns, index=False, mode='w')
+    write_id_prop(valid_data, valid_dir)
     # test
     test_dir = os.path.join(out_dir, "test/")
-    os.mkdir(test_dir)
-    test_file = os.path.join(test_dir, "id_prop.csv")
+    os.makedirs(test_dir, exist_ok=True)
     test_data = id_prop_all.iloc[valid_split:]
-    test_data.to_csv(test_file, sep=',', header=id_prop_all.columns, index=False, mode='w')
+    write_id_prop(test_data, test_dir)
     # point cloud data
-    for (save_data, save_dir) in [(train_data, train_dir), (valid_data, valid_dir), \
-                                  (test_data, test_dir)]:
-        for mat_id in save_data['material_id']:
-            if not neutron:
-                # XRD features
-                feat_file = "./MPdata_all/"+mat_id+"_XRD_conventional.npy"
-            else:
-                # ND features
-                feat_file = "./MPdata_all/"+mat_id+"_ND_conventional.npy"
-            assert(os.path.isfile(feat_file))
-            hkl_feat = np.load(feat_file)
-            # select hkl points
-            if npoint == 3:
-                conditions = np.where((np.sum(hkl_feat[:,:-1], axis=1)==1) & \
-                                      (np.min(hkl_feat[:,:-1], axis=1)>-1))
-                selected_hkl_feat = hkl_feat[conditions]
-                assert(selected_hkl_feat.shape[0] == 3)
-            elif npoint == 27:
-                conditions = np.where((np.max(hkl_feat[:,:-1], axis=1)<1.1) & \
-                                      (np.min(hkl_feat[:,:-1], axis=1)>-1.1))
-                selected_hkl_feat = hkl_feat[conditions]
-                assert(selected_hkl_feat.shape[0] <= 27)
-            elif npoint == 125:
-                conditions = np.where((np.max(hkl_feat[:,:-1], axis=1)<2.1) & \
-                                      (np.min(hkl_feat[:,:-1], axis=1)>-2.1))
-                selected_hkl_feat = hkl_feat[conditions]
-                assert(selected_hkl_feat.shape[0] <= 125)
-            elif npoint == 343:
-                conditions = np.where((np.max(hkl_feat[:,:-1], axis=1)<3.1) & \
-                                      (np.min(hkl_feat[:,:-1], axis=1)>-3.1))
-                selected_hkl_feat = hkl_feat[conditions]
-                assert(selected_hkl_feat.shape[0] <= 343)
+    build_point_clouds(id_prop_all['material_id'].tolist(), npoint, neutron, pool)
+    for (save_data, save_dir) in [(train_data, train_dir), (valid_data, valid_dir), (test_data, test_dir)]:
+        for mat_id in save_data['material_id'].to_numpy():
+            link_point_cloud(mat_id, save_dir, npoint, neutron)
+
+
+def cache_file(mat_id, npoint, neutron):
+    return os.path.join(CACHE_DIR, "{}_{}_{}.npz".format(mat_id, npoint, 'ND' if neutron else 'XRD'))
+
+
+def link_point_cloud(mat_id, save_dir, npoint, neutron):
+    # the same (mat_id, npoint, neutron) point cloud is shared by every
+    # dataset and random seed, it is built once and hard linked afterwards
+    save_file = os.path.join(save_dir, mat_id+'.npz')
+    try:
+        os.link(cache_file(mat_id, npoint, neutron), save_file)
+    except OSError:
+        shutil.copyfile(cache_file(mat_id, npoint, neutron), save_file)
+
+
+def build_point_clouds(mat_ids, npoint, neutron, pool):
+    # only build the point clouds that are not in the cache yet, in chunks
+    # of materials that are processed with whole-array operations. The
+    # lock only guards claiming the materials, point clouds claimed by
+    # another dataset are waited for instead of being written twice
+    with CACHE_LOCK:
+        cached = CACHED_POINT_CLOUDS[(npoint, neutron)]
+        todo = [mat_id for mat_id in mat_ids if mat_id not in cached]
+        for mat_id in todo:
+            cached[mat_id] = threading.Event()
+    try:
+        chunks = [todo[i:i+POINT_CLOUD_CHUNK] for i in range(0, len(todo), POINT_CLOUD_CHUNK)]
+        pool.starmap(build_point_cloud_chunk, [(chunk, npoint, neutron) for chunk in chunks])
+    finally:
+        for mat_id in todo:
+            cached[mat_id].set()
+    for mat_id in mat_ids:
+        cached[mat_id].wait()
+
+
+def gather_archive(mat_ids, kind):
+    # rows of all materials in one fancy index on the memory map, together
+    # with the position of the owning material for every row
+    rows, offsets, data = open_archive(kind)
+    imat = np.array([rows[mat_id] for mat_id in mat_ids])
+    starts, lengths = offsets[imat], offsets[imat+1] - offsets[imat]
+    owner = np.repeat(np.arange(len(mat_ids)), lengths)
+    irow = np.arange(owner.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths) \
+           + np.repeat(starts, lengths)
+    return np.asarray(data[irow]), owner
+
+
+def select_point_clouds(hkl_feat, owner, recip_latt, thresh, neutron):
+    # select hkl points
+    hkl = hkl_feat[:,:-1]
+    hkl_min = np.min(hkl, axis=1)
+    if thresh is None:
+        conditions = (np.sum(hkl, axis=1)==1) & (hkl_min>-1)
+    else:
+        conditions = (np.max(hkl, axis=1)<thresh) & (hkl_min>-thresh)
+    selected_hkl_feat = hkl_feat[conditions]
+    owner = owner[conditions]
+    counts = np.bincount(owner, minlength=recip_latt.shape[0])
+    # convert to Cartesion, every selected point with the basis of its material
+    recip_pos = np.einsum('ij,ijk->ik', selected_hkl_feat[:,:-1], recip_latt[owner])
+    # normalize diffraction intensity, in place on the selected copy
+    intensity = selected_hkl_feat[:,-1]
+    if not neutron:
+        np.log1p(intensity, out=intensity)
+        intensity /= 3.
+    return recip_pos, intensity, counts
+
+
+if njit is not None:
+    @njit(cache=True)
+    def select_point_clouds_numba(hkl_feat, owner, recip_latt, thresh, neutron):
+        # same as select_point_clouds in two passes over the rows, the first
+        # one counts the selected points, the second one converts them
+        # without any temporary arrays, thresh < 0 selects the unit vectors
+        n_row = hkl_feat.shape[0]
+        selected = np.empty(n_row, dtype=np.bool_)
+        counts = np.zeros(recip_latt.shape[0], dtype=np.int64)
+        for i in range(n_row):
+            h, k, l = hkl_feat[i,0], hkl_feat[i,1], hkl_feat[i,2]
+            hkl_min = min(h, k, l)
+            if thresh < 0:
+                selected[i] = (h + k + l == 1) and (hkl_min > -1)
             else:
-                raise NotImplementedError
-            
-            # convert to Cartesion
-            basis_file = "./MPdata_all/"+mat_id+"_conventional_basis.npy"
-            assert(os.path.isfile(basis_file))
-            recip_latt = np.load(basis_file)
-            recip_pos = np.dot(selected_hkl_feat[:,:-1], recip_latt)
-            # CuKa by default
-            max_r = 2 / 1.54184
-            recip_pos /= max_r
-            assert(np.amax(recip_pos) <= 1.0)
-            assert(np.amin(recip_pos) >= -1.0)
-            # normalize diffraction intensity
-            if not neutron:
-                intensity = np.log(1+selected_hkl_feat[:,-1]) / 3.
-                intensity = intensity.reshape(-1, 1)
+                selected[i] = (max(h, k, l) < thresh) and (hkl_min > -thresh)
+            if selected[i]:
+                counts[owner[i]] += 1
+        n_sel = counts.sum()
+        recip_pos = np.empty((n_sel, 3))
+        intensity = np.empty(n_sel)
+        j = 0
+        for i in range(n_row):
+            if not selected[i]:
+                continue
+            imat = owner[i]
+            for m in range(3):
+                recip_pos[j,m] = hkl_feat[i,0] * recip_latt[imat,0,m] \
+                               + hkl_feat[i,1] * recip_latt[imat,1,m] \
+                               + hkl_feat[i,2] * recip_latt[imat,2,m]
+            if neutron:
+                intensity[j] = hkl_feat[i,3]
             else:
-                intensity = selected_hkl_feat[:,-1]
-                intensity = intensity.reshape(-1, 1)
-            # make sure scale is reasonable
-            assert(np.amax(intensity) <= 2.5)
-            assert(np.amin(intensity) >= 0.)
+                intensity[j] = np.log1p(hkl_feat[i,3]) / 3.
+            j += 1
+        return recip_pos, intensity, counts
+
+
+def build_point_cloud_chunk(mat_ids, npoint, neutron):
+    if npoint not in NPOINT_THRESH:
+        raise NotImplementedError
+    thresh = NPOINT_THRESH[npoint]
+    # XRD or ND features of all materials stacked along the rows
+    hkl_feat, owner = gather_archive(mat_ids, 'ND' if neutron else 'XRD')
+    # reciprocal bases of the materials, scaled by 1/MAX_R
+    recip_latt = gather_archive(mat_ids, 'basis')[0].reshape(-1, 3, 3) / MAX_R
+    if njit is not None:
+        recip_pos, intensity, counts = select_point_clouds_numba(
+            hkl_feat, owner, recip_latt, -1. if thresh is None else thresh, neutron)
+    else:
+        recip_pos, intensity, counts = select_point_clouds(hkl_feat, owner, recip_latt,
+                                                           thresh, neutron)
+    if npoint == 3:
+        assert(np.all(counts == 3))
+    else:
+        assert(np.all(counts <= npoint))
+    assert(np.amax(recip_pos) <= 1.0)
+    assert(np.amin(recip_pos) >= -1.0)
+    # make sure scale is reasonable
+    assert(np.amax(intensity) <= 2.5)
+    assert(np.amin(intensity) >= 0.)
+
+    # write point clouds to the cache, positions in [-1, 1] are stored as
+    # float16, intensities as float32 since most of them are far below 1
+    # and span many orders of magnitude
+    splits = np.cumsum(counts)[:-1]
+    xyzs = np.split(recip_pos.astype(np.float16), splits)
+    intensities = np.split(intensity.astype(np.float32), splits)
+    for mat_id, xyz, I in zip(mat_ids, xyzs, intensities):
+        np.savez_compressed(cache_file(mat_id, npoint, neutron), xyz=xyz, I=I)
+
+
+def archive_files(kind):
+    return os.path.join(CACHE_DIR, kind+'_data.bin'), os.path.join(CACHE_DIR, kind+'_index.npz')
+
+
+def load_mp_file(args):
+    mat_id, kind = args
+    return np.load("./MPdata_all/"+mat_id+ARCHIVE_SUFFIX[kind])
+
+
+def pack_archive(kind, mat_ids, MPdata_files, pool):
+    # stream one kind of per-material input into a single flat float64 file,
+    # the workers then slice a memory map instead of opening a small .npy
+    # file for every material and every dataset
+    assert(all(mat_id+ARCHIVE_SUFFIX[kind] in MPdata_files for mat_id in mat_ids))
+    data_file, index_file = archive_files(kind)
+    offsets = [0]
+    ncol = 0
+    with open(data_file, 'wb') as f:
+        for arr in pool.imap(load_mp_file, [(mat_id, kind) for mat_id in mat_ids], chunksize=64):
+            assert(arr.ndim == 2)
+            assert(ncol in (0, arr.shape[1]))
+            ncol = arr.shape[1]
+            f.write(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+            offsets.append(offsets[-1] + arr.shape[0])
+    np.savez(index_file, material_id=np.array(mat_ids, dtype=str),
+             offsets=np.array(offsets), ncol=ncol)
+
+
+@lru_cache(maxsize=None)
+def open_archive(kind):
+    data_file, index_file = archive_files(kind)
+    index = np.load(index_file)
+    rows = {mat_id: i for i, mat_id in enumerate(index['material_id'].tolist())}
+    offsets = index['offsets']
+    if offsets[-1] == 0:
+        data = np.zeros((0, int(index['ncol'])))
+    else:
+        data = np.memmap(data_file, dtype=np.float64, mode='r').reshape(-1, int(index['ncol']))
+    return rows, offsets, data
+
 
-            # generate point cloud and write to file
-            point_cloud = np.concatenate((recip_pos, intensity), axis=1)
-            np.save(os.path.join(save_dir, mat_id), point_cloud)
+def load_elasticity(text):
+    # MP elasticity entries are python dict reprs, json.loads on the
+    # quote-swapped string is much faster than ast.literal_eval, which is
+    # kept for entries that are not valid json (None, True, quotes in text)
+    try:
+        return json.loads(text.replace("'", '"'))
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def parse_elasticity(elasticity):
+    # shear modulus, bulk modulus and poisson ratio of each entry
+    GKP = [[d['G_Voigt_Reuss_Hill'], d['K_Voigt_Reuss_Hill'], d['poisson_ratio']]
+           for d in elasticity.map(load_elasticity)]
+    return pd.DataFrame(GKP, index=elasticity.index, columns=['G', 'K', 'P'], dtype=float)
 
 
 def show_statistics(data):
@@ -382,7 +494,7 @@ def show_statistics(data):
 
     # space group
     sg_set = set()
-    for sg in data['spacegroup']:
+    for sg in data['spacegroup'].to_numpy():
         sg_dict = ast.literal_eval(sg)
         sg_set.add(sg_dict['number'])
     print('>> number of unique space groups: {:d}'.format(len(sg_set)))
@@ -407,10 +519,10 @@ def show_statistics(data):
                         nsites.min(), nsites.max()))
 
     # elements
-    elem_dict = defaultdict(int)
-    for compound in data['elements']:
-        for elem in ast.literal_eval(compound):
-            elem_dict[elem] += 1
+    # element lists are python list reprs of plain symbols, valid json
+    # once the quotes are swapped
+    elem_dict = Counter(elem for compound in data['elements'].to_numpy()
+                        for elem in json.loads(compound.replace("'", '"')))
     min_key = min(elem_dict, key=elem_dict.get)
     max_key = max(elem_dict, key=elem_dict.get)
     print('>> Number of unique elements: {:d}, min: {}({:d}), max: {}({:d})' \
@@ -462,14 +574,12 @@ def show_statistics(data):
     # elasticity
     elasticity = data['elasticity'].dropna()
     print('>> Number of elasticity data: {:d}'.format(elasticity.size))
-    Gs, Ks, Ps = [], [], []
-    for imat in elasticity:
-        shear_mod = ast.literal_eval(imat)['G_Voigt_Reuss_Hill']
-        Gs.append(shear_mod)
-        bulk_mod = ast.literal_eval(imat)['K_Voigt_Reuss_Hill']
-        Ks.append(bulk_mod)
-        poisson_ratio = ast.literal_eval(imat)['poisson_ratio']
-        Ps.append(poisson_ratio)
+    # reuse the columns parsed in __main__ when they are there
+    if {'G', 'K', 'P'}.issubset(data.columns):
+        GKP = data.loc[elasticity.index, ['G', 'K', 'P']]
+    else:
+        GKP = parse_elasticity(elasticity)
+    Gs, Ks, Ps = GKP['G'].to_numpy(), GKP['K'].to_numpy(), GKP['P'].to_numpy()
     print('Shear modulus > 50: {:d}'.format((np.array(Gs)>50).sum()))
     print('Bulk modulus > 100: {:d}'.format((np.array(Ks)>100).sum()))
     print('Shear modulus: mean = {:.2f}, median = {:.2f}, std = {:.2f}, '
@@ -483,8 +593,52 @@ def show_statistics(data):
            .format(np.mean(Ps), np.median(Ps), np.std(Ps), np.min(Ps), np.max(Ps)))
 
 
+def check_lattice_geometry(mat_ids, crystal_systems, latts):
+    # lattice lengths and angles of all conventional cells at once
+    latts = np.asarray(latts).reshape(-1, 3, 3)
+    lens = np.linalg.norm(latts, axis=2)
+    lena, lenb, lenc = lens.T
+    # angles between (a, b), (b, c) and (a, c)
+    first, second = [0, 1, 0], [1, 2, 2]
+    cos = np.einsum('nij,nij->ni', latts[:,first], latts[:,second]) / (lens[:,first]*lens[:,second])
+    theta_ab, theta_bc, theta_ac = (np.arccos(cos)/np.pi*180).T
+    a_eq_b = abs(lena - lenb) < 1E-2
+    b_eq_c = abs(lenb - lenc) < 1E-2
+    a_eq_c = abs(lena - lenc) < 1E-2
+    right_ab = abs(theta_ab-90) < 1E-1
+    right_bc = abs(theta_bc-90) < 1E-1
+    right_ac = abs(theta_ac-90) < 1E-1
+    checks = {
+        # a==b!=c, ab==120, bc==ac==90
+        'hexagonal': a_eq_b & (abs(theta_ab-120) < 1E-1) & right_bc & right_ac,
+        'trigonal': a_eq_b & (abs(theta_ab-120) < 1E-1) & right_bc & right_ac,
+        # a==b==c, ab==bc==ac==90
+        'cubic': a_eq_b & b_eq_c & a_eq_c & right_ab & right_bc & right_ac,
+        # a==b!=c, ab==bc==ac==90
+        'tetragonal': a_eq_b & right_ab & right_bc & right_ac,
+        # a!=b!=c, ab==bc==ac==90
+        'orthorhombic': right_ab & right_bc & right_ac,
+        # a!=b!=c, ab==bc==90, ac!=90
+        'monoclinic': right_ab & right_bc,
+        'triclinic': np.ones(latts.shape[0], dtype=bool),
+    }
+    crystal_systems = np.asarray(crystal_systems)
+    passed = np.zeros(latts.shape[0], dtype=bool)
+    for crystal_system, check in checks.items():
+        passed |= (crystal_systems == crystal_system) & check
+    # only report the entries that do not match their crystal system
+    for i in np.flatnonzero(~passed):
+        print(mat_ids[i])
+        if crystal_systems[i] in checks:
+            print(crystal_systems[i])
+        else:
+            print('UNK --', crystal_systems[i])
+        print(lena[i], lenb[i], lenc[i], theta_ab[i], theta_bc[i], theta_ac[i])
+
+
 def check_crystal_system(data_input, sym_thresh):
     drop_list =[]
+    mat_ids, crystal_systems, latts = [], [], []
     cnt = 0
     for idx, irow in data_input.iterrows():
         cnt += 1
@@ -500,78 +654,12 @@ def check_crystal_system(data_input, sym_thresh):
             print('sga:', sga.get_crystal_system(), ', MP:', irow['crystal_system'])
             drop_list.append(idx)
             continue
-        # get conventional cell
+        # get conventional cell, the lattices are checked together below
         conventional_struct = sga.get_conventional_standard_structure()
-        latt = conventional_struct.lattice.matrix
-        a, b, c = latt[0], latt[1], latt[2]
-        lena = np.linalg.norm(a)
-        lenb = np.linalg.norm(b)
-        lenc = np.linalg.norm(c)
-        theta_ab = np.arccos(np.dot(a,b)/(lena*lenb))/np.pi*180
-        theta_bc = np.arccos(np.dot(b,c)/(lenb*lenc))/np.pi*180
-        theta_ac = np.arccos(np.dot(a,c)/(lena*lenc))/np.pi*180
-        if irow['crystal_system'] == 'hexagonal' or \
-            irow['crystal_system'] == 'trigonal':
-            # a==b!=c, ab==120, bc==ac==90
-            try:
-                assert(abs(lena - lenb) < 1E-2)
-                assert(abs(theta_ab-120) < 1E-1)
-                assert(abs(theta_bc-90) < 1E-1)
-                assert(abs(theta_ac-90) < 1E-1)
-            except:
-                print(irow['material_id'])
-                print(irow['crystal_system'])
-                print(lena, lenb, lenc, theta_ab, theta_bc, theta_ac)
-        elif irow['crystal_system'] == 'cubic':
-            # a==b==c, ab==bc==ac==90
-            try:
-                assert(abs(lena - lenb) < 1E-2)
-                assert(abs(lenb - lenc) < 1E-2)
-                assert(abs(lena - lenc) < 1E-2)
-                assert(abs(theta_ab-90) < 1E-1)
-                assert(abs(theta_bc-90) < 1E-1)
-                assert(abs(theta_ac-90) < 1E-1)
-            except:
-                print(irow['material_id'])
-                print('cubic')
-                print(lena, lenb, lenc, theta_ab, theta_bc, theta_ac)
-        elif irow['crystal_system'] == 'tetragonal':
-            # a==b!=c, ab==bc==ac==90
-            try:
-                assert(abs(lena - lenb) < 1E-2)
-                assert(abs(theta_ab-90) < 1E-1)
-                assert(abs(theta_bc-90) < 1E-1)
-                assert(abs(theta_ac-90) < 1E-1)
-            except:
-                print(irow['material_id'])
-                print('tetragonal')
-                print(lena, lenb, lenc, theta_ab, theta_bc, theta_ac)
-        elif irow['crystal_system'] == 'orthorhombic':
-            # a!=b!=c, ab==bc==ac==90
-            try:
-                assert(abs(theta_ab-90) < 1E-1)
-                assert(abs(theta_bc-90) < 1E-1)
-                assert(abs(theta_ac-90) < 1E-1)
-            except:
-                print(irow['material_id'])
-                print('orthorhombic')
-                print(lena, lenb, lenc, theta_ab, theta_bc, theta_ac)
-        elif irow['crystal_system'] == 'monoclinic':
-            # a!=b!=c, ab==bc==90, ac!=90
-            try:
-                assert(abs(theta_ab-90) < 1E-1)
-                assert(abs(theta_bc-90) < 1E-1)
-            except:
-                print(irow['material_id'])
-                print('monoclinic')
-                print(lena, lenb, lenc, theta_ab, theta_bc, theta_ac)
-        else:
-            try:
-                assert(irow['crystal_system'] == 'triclinic')
-            except:
-                print(irow['material_id'])
-                print('UNK --', irow['crystal_system'])
-                print(lena, lenb, lenc, theta_ab, theta_bc, theta_ac)
+        mat_ids.append(irow['material_id'])
+        crystal_systems.append(irow['crystal_system'])
+        latts.append(conventional_struct.lattice.matrix)
+    check_lattice_geometry(mat_ids, crystal_systems, latts)
 
     print('number of entries to drop in this batch:', len(drop_list))
     data_out = data_input.drop(drop_list)
@@ -580,7 +668,8 @@ def check_crystal_system(data_input, sym_thresh):
 
 if __name__ == "__main__":
     # read all MPdata
-    MPdata_all = pd.read_csv("./MPdata_all/MPdata_all.csv", sep=';', header=0, index_col=None)
+    MPdata_all = pd.read_csv("./MPdata_all/MPdata_all.csv", sep=';', header=0, index_col=None,
+                             usecols=MP_COLUMNS)
 
     # show statistics of original data
     if False:
@@ -597,43 +686,82 @@ if __name__ == "__main__":
     df_split = np.array_split(MPdata_all, nworkers)
     args = [(data, sym_thresh) for data in df_split]
     MPdata_all = pd.concat(pool.starmap(check_crystal_system, args), axis=0)
-    pool.close()
-    pool.join()
     print('size of data with matched crystal system:', MPdata_all.shape[0])
 
-    if not os.path.exists('./datasets/'):
-        os.mkdir('./datasets/')
+    # filters shared by all datasets
+    # only take crystals in ICSD
+    print('>> remove entries with no ICSD IDs')
+    # only take no-warning entries
+    print('>> remove entries with warnings')
+    base = MPdata_all[(MPdata_all['icsd_ids'] != '[]') & (MPdata_all['warnings'] == '[]')]
+
+    # parse elasticity once for both elasticity datasets
+    base = base.join(parse_elasticity(base['elasticity'].dropna()))
+
+    # make sure only use compounds with simulated neutron scattering
+    MPdata_files = set(os.listdir('./MPdata_all/'))
+    ND_files = [fname.split('_')[0] for fname in MPdata_files if 'ND' in fname]
+    nd_base = base[base['material_id'].isin(ND_files)]
 
+    os.makedirs('./datasets/', exist_ok=True)
+    # start from an empty cache, point clouds depend on the current MPdata_all
+    reset_dir(CACHE_DIR, pool)
+
+    # read the per-material inputs once
+    pack_archive('XRD', base['material_id'].tolist(), MPdata_files, pool)
+    pack_archive('basis', base['material_id'].tolist(), MPdata_files, pool)
+    pack_archive('ND', nd_base['material_id'].tolist(), MPdata_files, pool)
+
+    # filter the datasets and show their statistics one at a time
+    jobs = []
     # XRD crystal system classification
     if True:
-        gen_Xsys_data(MPdata_all)
+        jobs += gen_Xsys_data(base)
 
     # XRD trigonal-hexagonal classification
     if True:
-        gen_THC_data(MPdata_all)
+        jobs += gen_THC_data(base)
 
     # XRD metal-insulator classification
     if True:
-        gen_MIC_data(MPdata_all)
+        jobs += gen_MIC_data(base)
 
     # XRD elasticity classification
     if True:
-        gen_elasticity_data(MPdata_all)
+        jobs += gen_elasticity_data(base)
 
     # XRD stability classification
     if True:
-        gen_stability_data(MPdata_all)
+        jobs += gen_stability_data(base)
 
     # neutron metal-insulator classification
     if True:
-        gen_neutron_MIC_data(MPdata_all)
+        jobs += gen_neutron_MIC_data(nd_base)
 
     # neutron elasticity classification
     if True:
-        gen_neutron_elasticity_data(MPdata_all)
+        jobs += gen_neutron_elasticity_data(nd_base)
 
     # neutron stability classification
     if True:
-        gen_neutron_stability_data(MPdata_all)
+        jobs += gen_neutron_stability_data(nd_base)
+
+    # the datasets are independent and generated concurrently, the heavy
+    # point cloud work of all of them goes through the shared process pool
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(generate_train_valid_test, id_prop, out_dir, npoint,
+                                       random_seed, pool, neutron=neutron)
+                       for (id_prop, out_dir, npoint, random_seed, neutron) in jobs]
+            for future in futures:
+                future.result()
+    finally:
+        # the archives duplicate the MP inputs, only the point clouds are kept
+        for kind in ARCHIVE_SUFFIX:
+            for archive_file in archive_files(kind):
+                os.remove(archive_file)
+
+    pool.close()
+    pool.join()
 
 
@@ -58,14 +58,20 @@ class deepKNetDataset(Dataset):
         self.rot_range = rot_range
         self.random_intensity = random_intensity
         self.systematic_absence = systematic_absence
-        id_prop_data = pd.read_csv(os.path.join(root, 'id_prop.csv'), \
-                                   header=0, sep=',', index_col=None)
+        # splits are written as parquet when pyarrow is available
+        if os.path.isfile(os.path.join(root, 'id_prop.parquet')):
+            id_prop_data = pd.read_parquet(os.path.join(root, 'id_prop.parquet'))
+        else:
+            id_prop_data = pd.read_csv(os.path.join(root, 'id_prop.csv'), \
+                                       header=0, sep=',', index_col=None)
         self.id_prop = id_prop_data.values
 
     def __getitem__(self, idx):
         material_id, target_prop = self.id_prop[idx]
-        # load point cloud data
-        point_cloud = np.load(os.path.join(self.root, material_id+'.npy'))
+        # load point cloud data, positions are stored in float16 and
+        # intensities in float32, work on them in double precision
+        with np.load(os.path.join(self.root, material_id+'.npz')) as data:
+            point_cloud = np.column_stack((data['xyz'], data['I'])).astype(np.float64)
         
         assert(point_cloud.shape[0] <= self.npoint)
         if point_cloud.shape[0] < self.npoint:
@@ -147,13 +153,15 @@ class deepKNetDataset(Dataset):
             prop = torch.Tensor([target_prop>1E-6])
         # binary bulk modulus
         elif self.target == 'bulk_modulus':
-            target_prop = ast.literal_eval(target_prop)
+            if isinstance(target_prop, str):
+                target_prop = ast.literal_eval(target_prop)
             bulk_mod = target_prop[1]
             criterion = bulk_mod >= 100. 
             prop = torch.Tensor([criterion])
         # binary shear modulus
         elif self.target == 'shear_modulus':
-            target_prop = ast.literal_eval(target_prop)
+            if isinstance(target_prop, str):
+                target_prop = ast.literal_eval(target_prop)
             shear_mod = target_prop[0]
             criterion = shear_mod >= 50. 
             prop = torch.Tensor([criterion])